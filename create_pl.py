@@ -1,10 +1,16 @@
 import typing as ty
+import os
 import sys
 import argparse
+import itertools
 import plistlib
 from pathlib import Path
 import urllib.parse
 import warnings
+import base64
+import datetime
+import xml.etree.ElementTree as ET
+import xml.sax.saxutils
 
 
 def make_parser():
@@ -52,13 +58,14 @@ def make_parser():
 
 
 def as_abs_path(
-    basedir: Path,
+    basedir: ty.Union[str, Path],
     path: ty.Union[str, Path],
-) -> Path:
-    path = Path(path)
-    if not path.is_absolute():
-        path = basedir / path
-    return path
+) -> str:
+    path = os.fspath(path)
+    # the common case of an absolute path needs no join with basedir
+    if not os.path.isabs(path):
+        path = os.path.join(basedir, path)
+    return os.path.normpath(path)
 
 
 def read_include_music_files(
@@ -67,44 +74,240 @@ def read_include_music_files(
 ) -> ty.List[str]:
     if files_from == '-':
         # read from stdin
-        files_to_include = [line.rstrip('\n') for line in sys.stdin]
+        files_to_include = sys.stdin.read().splitlines()
     elif files_from:
         # read from FILE_LIST
-        with open(Path(files_from), encoding='utf-8') as infile:
-            files_to_include = [line.rstrip('\n') for line in infile]
+        with open(Path(files_from), 'rb') as infile:
+            data = infile.read()
+        files_to_include = data.decode('utf-8').splitlines()
     else:
         # read from files_to_include; nothing else need to be done
         pass
     return files_to_include
 
 
+def plist_dict_elements(elem: ET.Element) -> ty.Dict[str, ET.Element]:
+    """
+    Map the keys of a plist ``<dict>`` element to their value elements,
+    without converting the values.
+
+    :param elem: the ``<dict>`` element
+    :return: a map from key to value element
+    """
+    children = iter(elem)
+    return {key.text or '': value for key, value in zip(children, children)}
+
+
+def _load_dict(elem: ET.Element) -> dict:
+    children = iter(elem)
+    return {
+        key.text or '': load_plist_element(value)
+        for key, value in zip(children, children)
+    }
+
+
+_PLIST_LOADERS = {
+    'dict': _load_dict,
+    'array': lambda elem: [load_plist_element(x) for x in elem],
+    'string': lambda elem: elem.text or '',
+    'integer': lambda elem: int(elem.text),
+    'real': lambda elem: float(elem.text),
+    'true': lambda elem: True,
+    'false': lambda elem: False,
+    # plist dates are always of the form '%Y-%m-%dT%H:%M:%SZ'
+    'date': lambda elem: datetime.datetime.fromisoformat(elem.text[:-1]),
+    'data': lambda elem: base64.b64decode(elem.text or ''),
+}
+
+
+def load_plist_element(elem: ET.Element) -> ty.Any:
+    """
+    Convert a parsed plist XML element to the Python object that
+    `plistlib.load` would have returned for it.
+
+    :param elem: the element, e.g. a ``<dict>`` or ``<string>``
+    :return: the converted Python object
+    """
+    return _PLIST_LOADERS[elem.tag](elem)
+
+
+def dump_plist_element(elem: ET.Element) -> str:
+    """
+    Serialize a parsed plist XML element back to XML. Much faster than
+    `ET.tostring` since plist elements carry neither attributes nor mixed
+    content. The whitespace between elements is not preserved.
+
+    :param elem: the element to serialize
+    :return: the XML fragment
+    """
+    parts = ['<', elem.tag, '>']
+    for child in elem:
+        if len(child):
+            parts.append(dump_plist_element(child))
+            continue
+        tag = child.tag
+        text = child.text
+        if text is None:
+            parts.extend(('<', tag, '/>'))
+        else:
+            if '&' in text or '<' in text or '>' in text:
+                text = xml.sax.saxutils.escape(text)
+            parts.extend(('<', tag, '>', text, '</', tag, '>'))
+    parts.extend(('</', elem.tag, '>'))
+    return ''.join(parts)
+
+
+def iter_library_xml(
+    infile: ty.BinaryIO,
+    base_plist: dict,
+) -> ty.Iterator[ty.Tuple[str, ET.Element]]:
+    """
+    Stream-parse the library XML. Each track under the 'Tracks' key is
+    yielded as soon as it has been read and is then detached from the
+    document tree, so that tracks not kept by the caller never pile up in
+    memory. The 'Playlists' entry is skipped without being materialized.
+
+    :param infile: the library XML opened in binary mode
+    :param base_plist: the dict to fill with the other top-level entries
+    :return: an iterator of (track id, track ``<dict>`` element)
+    """
+    # the open ancestors of the current element; <plist> and the top-level
+    # <dict> for a top-level key or value, plus the 'Tracks' <dict> for the
+    # keys and track dicts under it
+    ancestors = []
+    key = None
+    track_id = None
+    for event, elem in ET.iterparse(infile, events=('start', 'end')):
+        if event == 'start':
+            ancestors.append(elem)
+            continue
+        ancestors.pop()
+        depth = len(ancestors)
+        if depth == 2:
+            if elem.tag == 'key':
+                key = elem.text
+            elif key not in ('Tracks', 'Playlists'):
+                base_plist[key] = load_plist_element(elem)
+            ancestors[-1].clear()
+        elif key == 'Tracks':
+            if depth == 3:
+                if elem.tag == 'key':
+                    track_id = elem.text
+                else:
+                    yield track_id, elem
+                ancestors[-1].clear()
+        elif key == 'Playlists':
+            # drop every element as soon as it ends
+            ancestors[-1].clear()
+
+
 def parse_library_xml(
     xmlfile: Path,
     no_warnings: bool,
-) -> ty.Tuple[dict, ty.Dict[Path, dict]]:
+) -> ty.Tuple[dict, ty.Dict[str, ty.Tuple[int, bytes]]]:
     """
     Assume one physical file maps to at most one music item.
 
     :param xmlfile: the XML path to read
     :param no_warnings: whether to show warnings
-    :return: the base plist, a map from music file path to track dict
-    """
-    with open(xmlfile, 'rb') as infile:
-        plist = plistlib.load(infile)
-    location_to_track_dict = {}
-    for track_id, track_dict in plist['Tracks'].items():
-        loc = urllib.parse.urlparse(track_dict['Location'])
-        if loc.scheme != 'file':
-            if not no_warnings:
-                warnings.warn(
-                    'Skipped parsing track id={} since it\'s not a local file'
-                    .format(track_id))
-            continue
-        loc_path = Path(urllib.parse.unquote(loc.path))
-        location_to_track_dict[loc_path] = track_dict
-    del plist['Tracks']
-    del plist['Playlists']
-    return plist, location_to_track_dict
+    :return: the base plist, a map from normalized music file path to track
+             id and the track dict serialized as XML
+    """
+    base_plist = {}
+    location_to_track = {}
+    # local aliases for the hot loop below
+    unquote = urllib.parse.unquote
+    normpath = os.path.normpath
+    dict_elements = plist_dict_elements
+    dump_element = dump_plist_element
+    skipped = []
+    skipped_append = skipped.append
+    # a larger buffer than io.DEFAULT_BUFFER_SIZE feeds the parser in far
+    # fewer read syscalls
+    with open(xmlfile, 'rb', buffering=128 * 1024) as infile:
+        for track_id, track_elem in iter_library_xml(infile, base_plist):
+            track_dict_get = dict_elements(track_elem).get
+            loc = track_dict_get('Location')
+            # e.g. tracks in the cloud have no location at all
+            loc = '' if loc is None else loc.text or ''
+            if not loc.startswith('file://'):
+                skipped_append(track_id)
+                continue
+            # strip 'file://' and then the optional host up to the next '/'
+            raw = loc[7:]
+            slash = raw.find('/')
+            path_part = raw[slash:] if slash >= 0 else raw
+            decoded = unquote(path_part) if '%' in path_part else path_part
+            location_to_track[normpath(decoded)] = (
+                int(track_dict_get('Track ID').text),
+                dump_element(track_elem).encode('utf-8'))
+    if skipped and not no_warnings:
+        # one warning for all rather than one per track
+        warnings.warn(
+            'Skipped parsing {} tracks since they\'re not local files: '
+            'id={}{}'.format(
+                len(skipped), ', '.join(skipped[:10]),
+                ', ...' if len(skipped) > 10 else ''))
+    return base_plist, location_to_track
+
+
+def iter_plist_with_tracks(
+    plist: dict,
+    tracks: ty.Dict[int, bytes],
+) -> ty.Iterator[bytes]:
+    """
+    Serialize `plist` as `plistlib.dumps` does, plus a 'Tracks' entry whose
+    track dicts are spliced in as already serialized XML fragments. The
+    document is produced piece by piece so that it never has to be held in
+    memory as a whole.
+
+    :param plist: the plist to serialize, without 'Tracks'
+    :param tracks: a map from track id to serialized track dict
+    :return: an iterator of consecutive chunks of the XML document
+    """
+    head, end_dict, tail = plistlib.dumps(plist).rpartition(b'</dict>')
+    yield head
+    yield b'\t<key>Tracks</key>\n\t<dict>\n'
+    for tid, fragment in tracks.items():
+        yield b'\t\t<key>%d</key>\n\t\t%s\n' % (tid, fragment)
+    yield b''.join((b'\t</dict>\n', end_dict, tail))
+
+
+def _write_all(fd: int, data: ty.Union[bytes, bytearray]) -> None:
+    view = memoryview(data)
+    # os.write may write less than requested
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def write_chunks(
+    path: ty.Union[str, Path],
+    chunks: ty.Iterable[bytes],
+    bufsize: int = 128 * 1024,
+) -> None:
+    """
+    Write `chunks` to `path` through a raw file descriptor, bypassing the
+    buffered IO stack. Small chunks are coalesced into writes of about
+    `bufsize` bytes each.
+
+    :param path: the file to (over)write
+    :param chunks: the file content, piece by piece
+    :param bufsize: the number of bytes to collect before each write
+    """
+    fd = os.open(
+        path,
+        os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0),
+        0o666)
+    try:
+        buf = bytearray()
+        for chunk in chunks:
+            buf += chunk
+            if len(buf) >= bufsize:
+                _write_all(fd, buf)
+                buf.clear()
+        _write_all(fd, buf)
+    finally:
+        os.close(fd)
 
 
 class PlaylistsBuilder:
@@ -115,8 +318,10 @@ class PlaylistsBuilder:
         no_warnings: bool,
     ) -> None:
         self.basedir = basedir
-        self._base_plist, self._location_to_track_dict = parse_library_xml(
+        self._base_plist, self._location_to_track = parse_library_xml(
             library_xml, no_warnings)
+        # built on the first lookup miss; see `_find_track`
+        self._casefolded_location_to_track = None
         self.playlists = {}
         self.no_warnings = no_warnings
 
@@ -126,23 +331,43 @@ class PlaylistsBuilder:
     def __setitem__(self, name, value):
         self.playlists[name] = value
 
+    def _find_track(
+        self,
+        abspath: str,
+    ) -> ty.Optional[ty.Tuple[int, bytes]]:
+        track = self._location_to_track.get(abspath)
+        if track is None:
+            # The default file systems of macOS are case-insensitive, so the
+            # given path may differ in case from the library location.
+            if self._casefolded_location_to_track is None:
+                self._casefolded_location_to_track = {
+                    loc.casefold(): t
+                    for loc, t in self._location_to_track.items()
+                }
+            track = self._casefolded_location_to_track.get(abspath.casefold())
+        return track
+
     def build(self, output: Path) -> None:
         tracks_dict = {}
         name_to_track_ids = {}
+        # resolve the union of all include paths in one pass, so that a file
+        # shared by several playlists is looked up only once
+        resolved = dict.fromkeys(
+            itertools.chain.from_iterable(self.playlists.values()))
+        for path in resolved:
+            track = self._find_track(as_abs_path(self.basedir, path))
+            if track is None and not self.no_warnings:
+                warnings.warn('{} not found in library xml'.format(path))
+            resolved[path] = track
         for name, paths in self.playlists.items():
-            name_to_track_ids[name] = []
+            # an ordered set: each track once, where it is first listed
+            track_ids = name_to_track_ids[name] = {}
             for path in paths:
-                abspath = as_abs_path(self.basedir, path)
-                try:
-                    track_dict = self._location_to_track_dict[abspath]
-                except KeyError:
-                    if not self.no_warnings:
-                        warnings.warn(
-                            '{} not found in library xml'.format(path))
-                else:
-                    tid = track_dict['Track ID']
-                    name_to_track_ids[name].append(tid)
-                    tracks_dict[str(tid)] = track_dict
+                track = resolved[path]
+                if track is not None:
+                    tid, fragment = track
+                    track_ids[tid] = None
+                    tracks_dict[tid] = fragment
         playlists_dict = [
             {
                 'Name': name,
@@ -155,10 +380,9 @@ class PlaylistsBuilder:
                 } for tid in track_ids],
             } for name, track_ids in name_to_track_ids.items()
         ]
-        self._base_plist['Tracks'] = tracks_dict
         self._base_plist['Playlists'] = playlists_dict
-        with open(output, 'wb') as outfile:
-            plistlib.dump(self._base_plist, outfile)
+        write_chunks(
+            output, iter_plist_with_tracks(self._base_plist, tracks_dict))
 
 
 def main():